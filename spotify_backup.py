@@ -1,26 +1,100 @@
-import os
+import re
+import json
+import argparse
+import shutil
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from spotify_interface import SpotifyInterface
 from datetime import datetime
+from pathlib import Path
+from collections.abc import Iterator
 
-DIRECTORY = 'backup'
-if not os.path.exists(DIRECTORY):
-    os.mkdir(DIRECTORY)
+parser = argparse.ArgumentParser(description='Backup all playlists of the user.')
+parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet', help='File format of the backup')
+args = parser.parse_args()
 
-si = SpotifyInterface()
+DIRECTORY = Path('backup')
+DIRECTORY.mkdir(parents=True, exist_ok=True)
+
+MANIFEST_PATH = DIRECTORY / '.manifest.json'
+# playlist uri -> {'snapshot_id': ..., format: path of the last file written for that snapshot in that format}
+try:
+    with open(MANIFEST_PATH) as f:
+        manifest = json.load(f)
+except FileNotFoundError:
+    manifest = dict()
+
+si = SpotifyInterface(http_cache_path=str(DIRECTORY / '.http_cache.sqlite'))
 
 now = datetime.now().strftime('%Y-%m-%d')
 
+
+def write(df: pd.DataFrame, path: Path):
+    if args.format == 'parquet':
+        df.to_parquet(path, engine='pyarrow', compression='zstd', index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+# Fixed, so columns that are all None in the first chunk (e.g. added_at of very old playlists) are not inferred as null
+TRACK_SCHEMA = pa.schema([
+    (column, pa.int64() if column in ('duration', 'popularity') else pa.string())
+    for column in SpotifyInterface.TRACK_COLUMNS_BASIC
+])
+
+
+def write_chunks(chunks: Iterator[pd.DataFrame], path: Path, schema: pa.Schema):
+    """
+    Writes the chunks one after the other into a single file, so only one chunk is in memory at a time.
+    schema: Used for every chunk if the format is parquet
+    """
+    if args.format == 'parquet':
+        with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    else:
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(path, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+
+
+def get_file_name(name: str) -> str:
+    """
+    Replaces everything but word characters and dashes, so playlist names with slashes etc. make valid file names.
+    """
+    return re.sub(r'[^\w\-]+', '_', name)[:80]
+
+
 playlist_data = []
 for playlist in si.get_playlists_from_user():
     playlist_data.append(si.get_info_from_playlist(playlist))
-    
-    df = si.get_df_from_playlist(playlist, include_audio_features=False, verbose=True)
-    
-    df.to_csv('{}/{}_{}.csv'.format(DIRECTORY, playlist['name'], now), index=False)
-
-(
-    pd.DataFrame
-    .from_records(playlist_data, columns=si.PLAYLIST_COLUMNS)
-    .to_csv('{}/playlists_{}.csv'.format(DIRECTORY, now), index=False)
+
+    # The id keeps file names unique even if the sanitized names collide
+    path = DIRECTORY / '{}_{}_{}.{}'.format(get_file_name(playlist['name']), playlist['id'], now, args.format)
+    entry = manifest.get(playlist['uri'])
+    if not isinstance(entry, dict) or entry.get('snapshot_id') != playlist['snapshot_id']:
+        # Files written for other snapshots are outdated in every format
+        entry = {'snapshot_id': playlist['snapshot_id']}
+    old_path = entry.get(args.format)
+
+    if old_path is not None and Path(old_path).exists():
+        # The playlist did not change since the last backup
+        if Path(old_path) != path:
+            shutil.copyfile(old_path, path)
+    else:
+        chunks = si.get_df_chunks_from_playlist(
+            playlist, include_audio_features=False, verbose=True, playlist_name=playlist['name']
+        )
+
+        write_chunks(chunks, path, TRACK_SCHEMA)
+
+    entry[args.format] = str(path)
+    manifest[playlist['uri']] = entry
+
+with open(MANIFEST_PATH, 'w') as f:
+    json.dump(manifest, f)
+
+write(
+    pd.DataFrame.from_records(playlist_data, columns=si.PLAYLIST_COLUMNS),
+    DIRECTORY / 'playlists_{}.{}'.format(now, args.format)
 )
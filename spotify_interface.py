@@ -1,22 +1,37 @@
-import json
+from __future__ import annotations
+
 import logging
-import pandas as pd
+import time
+
+import orjson
 
+from requests.adapters import HTTPAdapter
 from spotipy import SpotifyException, Spotify
 from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
 
-from math import ceil
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
+from collections import deque
 from collections.abc import Iterator, Iterable
-from typing import Union, Optional
+from itertools import islice
+from operator import itemgetter
+from typing import Union, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 class SpotifyInterface:
     MAX_FEATURES = 100
+    MAX_WORKERS = 8
+    MAX_RETRIES = 5
+    POOL_SIZE = 32
     PLAYLIST_COLUMNS = ['name', 'description', 'uri', 'url', 'owner_name', 'owner_uri']
     TRACK_COLUMNS_BASIC = [
-        'added_at', 'uri', 'url', 'name', 'artist', 'album', 'album_date',
+        'added_at', 'uri', 'url', 'name',
+        'artist',
+        # JSON list of the artist names
+        'album', 'album_date',
         'duration',
         # In ms
         'popularity'
@@ -82,11 +97,16 @@ class SpotifyInterface:
         # negative (e.g. sad, depressed, angry).
     ]
     TRACK_COLUMNS = TRACK_COLUMNS_BASIC + TRACK_COLUMNS_AUDIO_FEATURES
+    _AUDIO_FEATURES_GETTER = itemgetter(*TRACK_COLUMNS_AUDIO_FEATURES)
+
+    def __init__(self, config_path='config.json', http_cache_path: Optional[str] = None):
+        """
+        http_cache_path: If given, HTTP responses are cached in an SQLite database at this path, see _tune_session
+        """
+        self.http_cache_path = http_cache_path
 
-    def __init__(self, config_path='config.json'):
-        
         with open(config_path, 'rb') as f:
-            self.config = json.load(f)
+            self.config = orjson.loads(f.read())
             
         client_credentials_manager = SpotifyClientCredentials(
             client_id=self.config['client_id'],
@@ -97,9 +117,12 @@ class SpotifyInterface:
             client_credentials_manager=client_credentials_manager,
             requests_timeout=self.config['requests_timeout']
         )
+        self._tune_session()
         
         self.user_id = self.config['user']
 
+        self.audio_features_cache: dict[str, Optional[dict]] = dict()
+
     def get_user_id_from_user(self, user: Union[str, dict] = None) -> str:
         """
         user: id, uri, or dict as returned by self.sp.user(id)
@@ -195,98 +218,169 @@ class SpotifyInterface:
 
         return info
 
-    def get_audio_features(self, tracks: Iterable[Union[str, dict]]) -> Iterator[dict]:
+    def get_audio_features(self, tracks: Iterable[Union[str, dict]], progress_bar=None) -> Iterator[dict]:
         """
         tracks: Sequence of ids, uris, or dicts as returned by self.sp.track(uri)
+        progress_bar: Optional tqdm progress bar, updated by the number of tracks as each request finishes
+        Audio features are cached by uri, only tracks not seen before are requested.
         """
         track_uris = [self.get_track_uri_from_track(track) for track in tracks]
-        return (
-            af
-            for i in range(ceil(len(track_uris) / self.MAX_FEATURES))
-            for af in self.sp.audio_features(track_uris[
-                                                 i * self.MAX_FEATURES:
-                                                 min((i + 1) * self.MAX_FEATURES, len(track_uris))
-                                             ])
-        )
+        missing_uris = list(dict.fromkeys(uri for uri in track_uris if uri not in self.audio_features_cache))
+        chunks = [missing_uris[i:i + self.MAX_FEATURES] for i in range(0, len(missing_uris), self.MAX_FEATURES)]
+
+        if progress_bar is not None:
+            progress_bar.update(len(track_uris) - len(missing_uris))
+
+        if chunks:
+            with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(chunks))) as executor:
+                results = executor.map(lambda chunk: self._call_with_retry(self.sp.audio_features, chunk), chunks)
+                for chunk, features in zip(chunks, results):
+                    self.audio_features_cache.update(zip(chunk, features))
+                    if progress_bar is not None:
+                        progress_bar.update(len(chunk))
+
+        return (self.audio_features_cache[uri] for uri in track_uris)
 
     def get_info_from_track(self, track: Union[str, dict]) -> dict[str, str]:
         """
         track: id, uri, or dict as returned by self.sp.track(uri)
         """
-        track = self.get_track_from_track(track)
-        if track is None:
+        values = self._get_values_from_track(track)
+        if values is None:
             return {key: None for key in self.TRACK_COLUMNS}
 
-        info = dict()
-        info['name'] = track['track']['name']
-        info['artist'] = repr(tuple(a['name'] for a in track['track']['artists']))
-        
-        info['added_at'] = track['added_at']
-        
-        info['album'] = track['track']['album']['name']
-        info['album_date'] = track['track']['album']['release_date']
-        
-        info['url'] = track['track']['external_urls'].get('spotify', None)
-        info['uri'] = track['track']['uri']
-        
-        info['duration'] = track['track']['duration_ms']
-        
-        info['popularity'] = track['track']['popularity']
-        
-        return info
+        return dict(zip(self.TRACK_COLUMNS_BASIC, values))
+
+    def _get_values_from_track(self, track: Union[str, dict]) -> Optional[tuple]:
+        """
+        track: id, uri, or dict as returned by self.sp.track(uri)
+        Returns the values in the order of TRACK_COLUMNS_BASIC, or None for invalid tracks.
+        """
+        track = self.get_track_from_track(track)
+        if track is None or track['track'] is None:
+            return None
+        t = track['track']
+        album = t['album']
+
+        return (
+            track['added_at'],
+            t['uri'],
+            t['external_urls'].get('spotify', None),
+            t['name'],
+            orjson.dumps([a['name'] for a in t['artists']]).decode(),
+            album['name'],
+            album['release_date'],
+            t['duration_ms'],
+            t['popularity']
+        )
 
     def get_info_from_audio_features(self, audio_features: dict) -> dict:
         """
         audio_features: Of a single track as returned by self.sp.audio_features(track)[0]
         """
-        return {
-            key: audio_features[key] if audio_features is not None else None
-            for key in self.TRACK_COLUMNS_AUDIO_FEATURES
-        }
+        if audio_features is None:
+            return {key: None for key in self.TRACK_COLUMNS_AUDIO_FEATURES}
+        return dict(zip(self.TRACK_COLUMNS_AUDIO_FEATURES, self._AUDIO_FEATURES_GETTER(audio_features)))
 
-    def get_df_from_playlist(self, playlist: Union[str, dict], include_audio_features=True, verbose=True
-                             ) -> pd.DataFrame:
+    def _append_info_from_track(self, columns: dict[str, list], track: Union[str, dict]):
+        """
+        Like get_info_from_track but appends the values to the lists in columns instead of building a dict.
+        Invalid tracks are skipped.
+        """
+        values = self._get_values_from_track(track)
+        if values is None:
+            return
+
+        for key, value in zip(self.TRACK_COLUMNS_BASIC, values):
+            columns[key].append(value)
+
+    def _append_info_from_audio_features(self, columns: dict[str, list], audio_features: dict):
+        """
+        Like get_info_from_audio_features but appends the values to the lists in columns instead of building a dict.
+        """
+        if audio_features is None:
+            for key in self.TRACK_COLUMNS_AUDIO_FEATURES:
+                columns[key].append(None)
+        else:
+            for key, value in zip(self.TRACK_COLUMNS_AUDIO_FEATURES, self._AUDIO_FEATURES_GETTER(audio_features)):
+                columns[key].append(value)
+
+    def get_df_from_playlist(self, playlist: Union[str, dict], include_audio_features=True, verbose=True,
+                             playlist_name: Optional[str] = None) -> pd.DataFrame:
+        """
+        playlist: id, uri, or dict as returned by self.sp.playlist(uri)
+        playlist_name: Only used for the progress bar, retrieved from the playlist if not given
         """
+        return next(self.get_df_chunks_from_playlist(
+            playlist, chunksize=None, include_audio_features=include_audio_features, verbose=verbose,
+            playlist_name=playlist_name
+        ))
+
+    def get_df_chunks_from_playlist(self, playlist: Union[str, dict], chunksize: Optional[int] = 500,
+                                    include_audio_features=True, verbose=True, playlist_name: Optional[str] = None
+                                    ) -> Iterator[pd.DataFrame]:
+        """
+        Like get_df_from_playlist but yields DataFrames of at most chunksize tracks, so the whole playlist never needs
+        to be held in memory. Yields at least one (possibly empty) DataFrame.
         playlist: id, uri, or dict as returned by self.sp.playlist(uri)
+        chunksize: If None, the whole playlist is yielded as a single DataFrame
+        playlist_name: Only used for the progress bar, retrieved from the playlist if not given
         """
+        import pandas as pd
+        from tqdm import tqdm
+
         track_iterator = self.get_tracks_from_playlist(playlist)
         if verbose:
-            playlist_name = self.get_info_from_playlist(playlist)['name']
+            playlist_name = self._get_playlist_name(playlist, playlist_name)
             track_iterator = tqdm(
                 track_iterator,
                 unit=' tracks',
                 desc='Retrieving tracks from playlist {}'.format(playlist_name)
             )
 
-        df = pd.DataFrame.from_records(
-            (
-                self.get_info_from_track(track)
-                for track in track_iterator
-            ),
-            columns=self.TRACK_COLUMNS_BASIC
-        )
-
-        df.dropna(subset=['uri'], inplace=True)  # drop rows from invalid URIs
-
-        if include_audio_features:
-            features_iterator = self.get_audio_features(df['uri'])
-
-            if verbose:
-                features_iterator = tqdm(
-                    features_iterator,
-                    unit=' tracks',
-                    desc='Retrieving audio features from playlist {}'.format(playlist_name),
-                    total=len(df)
-                )
-
-            df_features = pd.DataFrame.from_records(
-                (self.get_info_from_audio_features(feature) for feature in features_iterator),
-                columns=self.TRACK_COLUMNS_AUDIO_FEATURES
-            )
-
-            df = pd.concat((df, df_features), axis=1)
-
-        return df
+        def get_df(columns: dict[str, list]) -> pd.DataFrame:
+            if include_audio_features:
+                progress_bar = None
+                if verbose and chunksize is None:
+                    progress_bar = tqdm(
+                        unit=' tracks',
+                        desc='Retrieving audio features from playlist {}'.format(playlist_name),
+                        total=len(columns['uri'])
+                    )
+
+                features_iterator = self.get_audio_features(columns['uri'], progress_bar=progress_bar)
+                if progress_bar is not None:
+                    progress_bar.close()
+
+                columns.update({key: [] for key in self.TRACK_COLUMNS_AUDIO_FEATURES})
+                for feature in features_iterator:
+                    self._append_info_from_audio_features(columns, feature)
+
+            return pd.DataFrame(columns, copy=False)
+
+        columns = {key: [] for key in self.TRACK_COLUMNS_BASIC}
+        empty = True
+        for track in track_iterator:
+            self._append_info_from_track(columns, track)
+            if chunksize is not None and len(columns['uri']) >= chunksize:
+                yield get_df(columns)
+                empty = False
+                columns = {key: [] for key in self.TRACK_COLUMNS_BASIC}
+
+        if columns['uri'] or empty:
+            yield get_df(columns)
+
+    def _get_playlist_name(self, playlist: Union[str, dict], playlist_name: Optional[str] = None) -> str:
+        """
+        playlist: id, uri, or dict as returned by self.sp.playlist(uri)
+        Only retrieves the playlist if neither playlist_name is given nor playlist is a dict.
+        """
+        if playlist_name is not None:
+            return playlist_name
+        elif type(playlist) == dict:
+            return playlist['name']
+        else:
+            return self.get_info_from_playlist(playlist)['name']
 
     def authorize(self, scope: str):
         """
@@ -301,6 +395,43 @@ class SpotifyInterface:
         )
 
         self.sp = Spotify(auth_manager=auth_manager, requests_timeout=self.config['requests_timeout'])
+        self._tune_session()
+
+    def _tune_session(self):
+        """
+        Mounts adapters with a connection pool big enough for MAX_WORKERS concurrent requests on the requests session of
+        self.sp, keeping the retry configuration of spotipy, and makes the responses decode their JSON with orjson.
+        If self.http_cache_path is set, the session is first replaced by a requests_cache.CachedSession. Cached
+        responses are always revalidated (ETag / If-None-Match), so e.g. snapshot ids of playlists are never stale.
+        """
+        max_retries = {prefix: self.sp._session.get_adapter(prefix).max_retries for prefix in ('https://', 'http://')}
+
+        if self.http_cache_path is not None:
+            import requests_cache
+
+            self.sp._session = requests_cache.CachedSession(
+                self.http_cache_path,
+                backend='sqlite',
+                cache_control=False,  # Else max-age headers would override EXPIRE_IMMEDIATELY
+                expire_after=requests_cache.EXPIRE_IMMEDIATELY
+            )
+
+        self.sp._session.hooks['response'].append(self._use_orjson)
+        for prefix in ('https://', 'http://'):
+            self.sp._session.mount(prefix, HTTPAdapter(
+                pool_connections=self.POOL_SIZE,
+                pool_maxsize=self.POOL_SIZE,
+                max_retries=max_retries[prefix]
+            ))
+
+    @staticmethod
+    def _use_orjson(response, *args, **kwargs):
+        """
+        Response hook replacing response.json, which spotipy uses to decode every response, with orjson.
+        orjson.JSONDecodeError is a ValueError, like the errors spotipy expects from response.json().
+        """
+        response.json = lambda **_: orjson.loads(response.content)
+        return response
 
     def reorder_playlist(self, playlist: Union[str, dict], new_order: [int], verbose=True):
         """
@@ -308,6 +439,8 @@ class SpotifyInterface:
         new_order: (reordered) list of the indices 0 to len(list(self.get_tracks_from_playlist(playlist)))
                    The track at position new_order[i] will be at position i after reordering.
         """
+        from tqdm import tqdm
+
         playlist_uri = self.get_playlist_uri_from_playlist(playlist)
         len_order = len(new_order)
 
@@ -339,14 +472,45 @@ class SpotifyInterface:
                 order.insert(i, order.pop(old_index))
                 reorder_single_track(old_index, i)
 
+    @staticmethod
+    def _call_with_retry(function, *args, **kwargs):
+        """
+        Calls function and retries if the Spotify API answers with 429 (too many requests), honoring Retry-After.
+        """
+        for attempt in range(SpotifyInterface.MAX_RETRIES):
+            try:
+                return function(*args, **kwargs)
+            except SpotifyException as e:
+                if e.http_status != 429 or attempt == SpotifyInterface.MAX_RETRIES - 1:
+                    raise e
+                retry_after = (e.headers or {}).get('Retry-After')
+                time.sleep(int(retry_after) if retry_after is not None else 2 ** attempt)
+
     @staticmethod
     def _get_all_items(getter_function, uri) -> Iterator:
-        offset = 0
-        while True:
-            response = getter_function(uri, offset=offset)
-            new_items = response['items']
-            for item in new_items:
-                yield item
-            offset += response['limit']
-            if response['next'] is None:
-                break
+        """
+        Retrieves the first page to learn total and limit, then the remaining pages concurrently.
+        At most MAX_WORKERS pages are requested ahead of the one being yielded, so slowly consumed items do not pile
+        up in memory. Items are yielded in the original order.
+        """
+        response = SpotifyInterface._call_with_retry(getter_function, uri, offset=0)
+        yield from response['items']
+
+        if response['next'] is None:
+            return
+
+        limit = response['limit']
+        offsets = iter(range(limit, response['total'], limit))
+
+        def get_page(offset):
+            return SpotifyInterface._call_with_retry(getter_function, uri, offset=offset, limit=limit)
+
+        with ThreadPoolExecutor(max_workers=SpotifyInterface.MAX_WORKERS) as executor:
+            pending = deque(
+                executor.submit(get_page, offset) for offset in islice(offsets, SpotifyInterface.MAX_WORKERS)
+            )
+            while pending:
+                page = pending.popleft().result()
+                for offset in islice(offsets, 1):
+                    pending.append(executor.submit(get_page, offset))
+                yield from page['items']